@@ -1,17 +1,531 @@
-from uuid import uuid4 as uuid
 from pathlib import Path
-from subprocess import Popen, STDOUT, PIPE
 import sys
 import os
 import signal
+import selectors
 from argparse import ArgumentParser
-import dill
+import itertools
+import functools
+import collections
+import io
+import pickle
+import hashlib
+import base64
+import mmap
+import marshal
+import types
+import threading
 import time
+import weakref
+# `subprocess` and `concurrent.futures` are only needed by the
+# scheduling process, and are imported where they are used. This way,
+# every task process starts faster.
 
 def _identity(thing):
     """Just a helper."""
     return thing
 
+
+class _Pickler(pickle.Pickler):
+    """A `pickle.Pickler` that refuses to reference `__main__`.
+
+    Functions and classes are pickled by reference. Since worker
+    processes do not share the `__main__` module of the scheduling
+    process, anything defined there must be pickled by value by
+    `dill` instead. If `directory` is given, such functions and
+    classes, as well as lambdas and local functions, are pickled by
+    `dill` to `{directory}/shared`, named by their content, and only
+    referenced by that name.
+
+    Tasks within `obj` whose `_id` is in `shared_tasks` are saved to
+    `{directory}/shared` instead, and only referenced by their `_id`.
+    Other tasks within `obj` are added to `new_tasks`.
+
+    The same `_Pickler` can be used for many objects, if it is
+    `prepare`d for each of them.
+
+    """
+
+    def __init__(self, file, **kwargs):
+        super().__init__(file, buffer_callback=self._buffer_callback, **kwargs)
+        self.file = file
+        self.prepare()
+
+    def prepare(self, obj=None, directory=None, shared_tasks=None, buffer_callback=None):
+        """Forget everything about the previous object, and prepare for `obj`."""
+        self.file.seek(0)
+        self.file.truncate()
+        self.clear_memo()
+        self.obj = obj
+        self.directory = directory
+        self.shared_tasks = shared_tasks
+        self.buffer_callback = buffer_callback
+        self.new_tasks = set()
+
+    def _buffer_callback(self, buffer):
+        if self.buffer_callback is None:
+            return True # pickle in-band
+        return self.buffer_callback(buffer)
+
+    def reducer_override(self, obj):
+        if (isinstance(obj, (type, types.FunctionType)) and
+            getattr(obj, '__module__', None) == '__main__'):
+            raise pickle.PicklingError(f'{obj!r} is defined in __main__')
+        return NotImplemented
+
+    def persistent_id(self, obj):
+        if type(obj) in _evaluators:
+            return self._share_task(obj)
+        if (self.directory is not None and
+            isinstance(obj, (type, types.FunctionType)) and
+            (getattr(obj, '__module__', None) == '__main__' or
+             '<' in getattr(obj, '__qualname__', ''))): # lambdas and local functions
+            return self._share_by_value(obj)
+        return None
+
+    def _share_task(self, obj):
+        if self.shared_tasks is None or obj is self.obj:
+            return None
+        if obj._id not in self.shared_tasks:
+            self.new_tasks.add(obj._id)
+            return None
+        path = self.directory / 'shared' / obj._id
+        if not path.exists():
+            _write_shared(path, _dumps(obj, self.directory, self.shared_tasks))
+        return obj._id
+
+    def _share_by_value(self, obj):
+        data, name = _dumps_by_value(obj)
+        if data is None:
+            return None # fail as usual
+        path = self.directory / 'shared' / name
+        if not path.exists():
+            _write_shared(path, data)
+        return name
+
+
+# functions pickled by value, with the state they were pickled with:
+_by_value_cache = weakref.WeakKeyDictionary()
+_immutable_types = (int, float, complex, bool, str, bytes, type(None))
+
+
+def _dumps_by_value(obj):
+    """Pickle `obj` by value with `dill`, and name the data by its content.
+
+    Returns `(data, name)`, or `(None, None)` if `obj` can't be
+    pickled. Functions without closures or mutable defaults always
+    pickle to the same data, since `dill` saves their globals by
+    reference, so their data is cached.
+
+    """
+    import dill
+    state = None
+    if (type(obj) is types.FunctionType and obj.__closure__ is None and
+        not obj.__dict__ and not dill.settings['recurse'] and
+        all(type(value) in _immutable_types for value in
+            (*(obj.__defaults__ or ()), *(obj.__kwdefaults__ or {}).values()))):
+        state = (obj.__code__, obj.__defaults__, obj.__kwdefaults__,
+                 obj.__name__, obj.__qualname__, obj.__module__)
+        cached = _by_value_cache.get(obj)
+        if cached is not None and cached[0] == state:
+            return cached[1:]
+    try:
+        data = dill.dumps(obj, protocol=5)
+    except Exception:
+        return None, None
+    name = hashlib.blake2b(data, digest_size=16).hexdigest()
+    if state is not None:
+        _by_value_cache[obj] = (state, data, name)
+    return data, name
+
+
+# creating a `_Pickler` for every object is slow, so reuse this one:
+_pickler = _Pickler(io.BytesIO(), protocol=5)
+_pickler_lock = threading.Lock()
+
+
+def _write_shared(path, data):
+    """Write `data` to `path` in `{directory}/shared`, atomically.
+
+    Shared files are named by their content, so several processes
+    might write the same file at once. Each writes its own temporary
+    file, and whichever is replaced last wins.
+
+    """
+    if path.exists():
+        return
+    path.parent.mkdir(exist_ok=True)
+    tmp = f'{path}.{os.getpid()}-{threading.get_ident()}-{os.urandom(4).hex()}.tmp'
+    try:
+        _write_file(tmp, data)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        if not path.exists(): # otherwise, someone else wrote it
+            raise
+
+
+def _load_shared(directory, name, memo):
+    """Load a task or function saved by `_Pickler` to `{directory}/shared`.
+
+    `memo` holds the objects loaded so far by the current `_loads`, so
+    every shared name is only unpickled once per load.
+
+    """
+    if name not in memo:
+        data = _shared_files.read(str(directory / 'shared' / name))
+        memo[name] = _loads(data, directory, memo=memo)
+    return memo[name]
+
+
+class _IdPickler(pickle.Pickler):
+    """A `pickle.Pickler` that calculates a digest of an object.
+
+    Tasks are referred to by their `_id`, and functions by their name,
+    code, defaults, and closure, so changed functions get different
+    digests. Sets are referred to by the sorted digests of their
+    items, since their order changes with hash randomization.
+    Out-of-band buffers, such as large numpy arrays, are fed to the
+    digest without copying them.
+
+    """
+
+    def __init__(self):
+        self.file = io.BytesIO()
+        self.digest = hashlib.blake2b(digest_size=16)
+        super().__init__(self.file, protocol=5, buffer_callback=self._buffer_callback)
+
+    def hexdigest(self, obj):
+        """Return the digest of `obj`."""
+        self.dump(obj)
+        self.digest.update(self.file.getbuffer())
+        return self.digest.hexdigest()
+
+    def _buffer_callback(self, buffer):
+        try:
+            raw = buffer.raw()
+        except BufferError: # not contiguous
+            return True # pickle in-band
+        self.digest.update(raw.nbytes.to_bytes(8, 'little'))
+        self.digest.update(raw)
+        return False
+
+    def persistent_id(self, obj):
+        if type(obj) in _evaluators:
+            return obj._id
+        if type(obj) is types.FunctionType:
+            closure = obj.__closure__ or ()
+            return (obj.__module__, obj.__qualname__, _code_digest(obj.__code__),
+                    obj.__defaults__, obj.__kwdefaults__,
+                    tuple(cell.cell_contents for cell in closure))
+        if type(obj) in (set, frozenset):
+            return (type(obj).__name__,
+                    tuple(sorted(_IdPickler().hexdigest(item) for item in obj)))
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _code_digest(code):
+    """Return a digest of the code object `code`."""
+    return hashlib.blake2b(marshal.dumps(code), digest_size=16).digest()
+
+
+# unique `_id`s for tasks that can't be pickled:
+_unique_id_prefix = os.urandom(16).hex()
+_unique_id_counter = itertools.count()
+
+
+def _task_id(task):
+    """Calculate an `_id` from the function and arguments of `task`.
+
+    Equal function calls get equal `_id`s, and are therefore only
+    evaluated once. Function calls that can't be pickled always get a
+    unique `_id`.
+
+    """
+    try:
+        return _IdPickler().hexdigest((task._fun, task._args, task._kwargs))
+    except Exception:
+        # unlike `id(task)`, this is never reused by another task:
+        return f'{_unique_id_prefix}-{next(_unique_id_counter)}'
+
+
+def _write_file(path, data):
+    """Write `data` to the file at `path`.
+
+    This writes directly to the file descriptor, without the buffering
+    and file objects of `open`. As before, the file is not `fsync`ed.
+
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def _read_file(path, size=None):
+    """Read the file at `path`, which is `size` bytes long.
+
+    Like `_write_file`, this reads directly from the file descriptor.
+    If `size` is known, this needs no more than three syscalls.
+
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if size is None:
+            size = os.fstat(fd).st_size
+        data = os.read(fd, size)
+        while len(data) < size: # large files are read in several parts
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        os.close(fd)
+    return data
+
+
+class _FileCache:
+    """A cache of file contents, bounded by their total size.
+
+    Files are keyed by their path, modification time, and size, so
+    changed files are read again. Only bytes are cached, never
+    unpickled objects, since tasks might modify those.
+
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._size = 0
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path, stat=None):
+        """Read the file at `path`, or return its cached contents."""
+        if stat is None:
+            stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            data = self._files.get(key)
+            if data is not None:
+                self._files.move_to_end(key)
+                return data
+        data = _read_file(path, stat.st_size)
+        if len(data) > self.limit:
+            return data
+        with self._lock:
+            if key not in self._files:
+                self._files[key] = data
+                self._size += len(data)
+            while self._size > self.limit:
+                _, old = self._files.popitem(last=False)
+                self._size -= len(old)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._size = 0
+
+
+# contents of shared functions and tasks, which are the same for every
+# task that uses them:
+_shared_files = _FileCache(16 * 1024 * 1024)
+
+
+# buffers larger than this are stored in `{directory}/shared`:
+_shared_buffer_size = 1024 * 1024
+
+
+# pickles larger than this are compressed, if `lz4` is installed:
+_compress_size = 64 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def _lz4():
+    """Return `lz4.frame`, or `None` if it is not installed."""
+    try:
+        import lz4.frame
+        return lz4.frame
+    except ImportError:
+        return None
+
+
+class _SharedBuffers:
+    """Pickled data whose large buffers are stored in `{directory}/shared`."""
+
+    def __init__(self, names, data):
+        self.names = names
+        self.data = data
+
+
+def _dumps(obj, directory=None, shared_tasks=None):
+    """Serialize `obj` with `pickle` if possible, and with `dill` otherwise.
+
+    The standard `pickle` is much faster than `dill`, but can't
+    serialize lambdas, closures, or things defined in `__main__`.
+
+    If `directory` is given, large buffers such as big numpy arrays
+    are saved to `{directory}/shared` instead, named by their content.
+    Thus, they are only saved once, even if many tasks use them.
+
+    Similarly, tasks within `obj` whose `_id` is in `shared_tasks` are
+    saved to `{directory}/shared` and referenced by their `_id`. All
+    other tasks within `obj` are added to `shared_tasks`, so they are
+    shared the next time they are seen. This only works with `pickle`,
+    not with `dill`.
+
+    """
+    names = []
+
+    def share_buffer(buffer):
+        try:
+            view = buffer.raw()
+        except BufferError: # not contiguous
+            return True
+        if directory is None or view.nbytes < _shared_buffer_size:
+            return True # pickle in-band
+        name = hashlib.blake2b(view, digest_size=16).hexdigest()
+        path = directory / 'shared' / name
+        if not path.exists():
+            _write_shared(path, view)
+        names.append(name)
+        return False # pickle out-of-band
+
+    if _pickler_lock.acquire(blocking=False):
+        pickler = _pickler
+    else: # in use by another thread, or for a task within a task
+        pickler = _Pickler(io.BytesIO(), protocol=5)
+    try:
+        pickler.prepare(obj, directory, shared_tasks, share_buffer)
+        pickler.dump(obj)
+        data = pickler.file.getvalue()
+        if shared_tasks is not None:
+            shared_tasks |= pickler.new_tasks
+    except Exception:
+        names.clear()
+        import dill
+        data = dill.dumps(obj, protocol=5, buffer_callback=share_buffer)
+    finally:
+        pickler.prepare() # do not keep `obj` alive
+        if pickler is _pickler:
+            _pickler_lock.release()
+    if names:
+        data = pickle.dumps(_SharedBuffers(names, data), protocol=5)
+    if len(data) >= _compress_size and _lz4() is not None:
+        compressed = _lz4().compress(data)
+        if len(compressed) < len(data):
+            # pickles start with b'\x80', so this is unambiguous:
+            data = b'L' + compressed
+    return data
+
+
+def _loads(data, directory=None, shared_names=None, memo=None):
+    """Deserialize data produced by `_dumps`.
+
+    Shared buffers are memory-mapped from `{directory}/shared`, and
+    only copied once they are written to. Shared tasks are loaded from
+    `{directory}/shared`. Their file contents are cached, but every
+    call unpickles them anew, so no two calls share any objects. If
+    `shared_names` is given, the names of all shared tasks and
+    functions are added to it.
+
+    """
+    if memo is None:
+        memo = {}
+    if data[:1] == b'L':
+        if _lz4() is None:
+            raise RuntimeError('data is compressed with lz4, which is not installed')
+        data = _lz4().decompress(memoryview(data)[1:])
+    obj = _unpickle(data, directory, memo, shared_names=shared_names)
+    if type(obj) is _SharedBuffers:
+        buffers = []
+        for name in obj.names:
+            with open(directory / 'shared' / name, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            buffers.append(pickle.PickleBuffer(buffer))
+        obj = _unpickle(obj.data, directory, memo, buffers, shared_names)
+    return obj
+
+
+def _unpickle(data, directory, memo, buffers=None, shared_names=None):
+    """Unpickle `data` with `pickle` if possible, and with `dill` otherwise.
+
+    `dill` takes a long time to import, and is therefore only imported
+    for data that was pickled by `dill`.
+
+    """
+    def persistent_load(name):
+        if shared_names is not None:
+            shared_names.add(name)
+        return _load_shared(directory, name, memo)
+    try:
+        unpickler = pickle.Unpickler(io.BytesIO(data), buffers=buffers)
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+    except Exception:
+        import dill
+        unpickler = dill.Unpickler(io.BytesIO(data), buffers=buffers)
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+
+def _save_session(sessionfile, previous=None):
+    """Save the globals of `__main__` to `sessionfile`.
+
+    Globals are serialized with `_dumps`, so `dill` is only used if
+    necessary. Modules are saved by name, and globals that can't be
+    serialized at all, such as open files, are skipped.
+
+    Returns a digest of the session. If it is equal to `previous`,
+    the session did not change, and `sessionfile` is not written again.
+
+    """
+    import __main__
+    modules = {}
+    variables = {}
+    for name, value in vars(__main__).items():
+        if name.startswith('__'): # `__name__`, `__builtins__`, etc.
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+        else:
+            variables[name] = value
+    try:
+        data = _dumps(variables)
+    except Exception:
+        # serialize only what can be serialized:
+        for name, value in list(variables.items()):
+            try:
+                _dumps(value)
+            except Exception:
+                del variables[name]
+        data = _dumps(variables)
+    data = pickle.dumps((modules, data), protocol=5)
+    digest = hashlib.blake2b(data).digest()
+    if digest != previous or not sessionfile.exists():
+        _write_file(sessionfile, data)
+    return digest
+
+
+def _load_session(sessionfile):
+    """Load the globals saved by `_save_session` into `__main__`."""
+    import __main__
+    import importlib
+    modules, data = pickle.loads(_read_file(sessionfile))
+    for name, module in modules.items():
+        try:
+            setattr(__main__, name, importlib.import_module(module))
+        except Exception:
+            pass # not available in this process
+    vars(__main__).update(_loads(data))
+
 def defer(fun, *args, **kwargs):
     """Wrap a function or data for execution.
 
@@ -26,6 +540,9 @@ def defer(fun, *args, **kwargs):
     Additionally, you can access attributes and indexes of the
     `Task`.
 
+    Deferring the same function with equal arguments several times
+    returns equal `Tasks`, which are only evaluated once.
+
     """
     if not callable(fun) and not isinstance(fun, Task):
         # return non-functions varbatim
@@ -42,22 +559,48 @@ class Task:
 
     """
 
+    _state = ('_fun', '_args', '_kwargs', '_id', '_deferred_args', '_deferred_kwargs',
+              'metadata', 'returnvalue', 'errorvalue', 'runtime')
+    __slots__ = _state + ('_children',)
+
     def __init__(self, fun, args, kwargs):
         self._fun = fun
         self._args = args
         self._kwargs = kwargs
-        self._id = str(id(self))
+        # which arguments are tasks themselves:
+        self._deferred_args = tuple(idx for idx, arg in enumerate(args)
+                                    if type(arg) in _evaluators)
+        self._deferred_kwargs = tuple(key for key, arg in kwargs.items()
+                                      if type(arg) in _evaluators)
+        self.metadata = self.returnvalue = self.errorvalue = self.runtime = None
+        self._children = None
+
+    def __getstate__(self):
+        return _compact_state(self, Task._state)
+
+    def __setstate__(self, state):
+        if _restore_state(self, Task._state, state): # an old `__dict__`
+            self._deferred_args = tuple(idx for idx, arg in enumerate(self._args)
+                                        if type(arg) in _evaluators)
+            self._deferred_kwargs = tuple(key for key, arg in self._kwargs.items()
+                                          if type(arg) in _evaluators)
+        if self._id is None: # calculate it on first use
+            del self._id
 
     def __eq__(self, other):
-        return self._id == other._id and self._args == other._args and self._fun == other._fun
+        return type(other) is type(self) and self._id == other._id
+
+    def __hash__(self):
+        return hash(self._id)
 
     def __getattr__(self, name):
-        if name in ['__getstate__', '_id']:
-            raise AttributeError()
-        return TaskAttribute(self, name)
+        if name == '_id': # calculated on first use, since this pickles all arguments
+            self._id = _task_id(self)
+            return self._id
+        return _child_task(self, TaskAttribute, name)
 
     def __getitem__(self, key):
-        return TaskItem(self, key)
+        return _child_task(self, TaskItem, key)
 
 
 class PartOfTask():
@@ -69,29 +612,144 @@ class PartOfTask():
 
     """
 
+    # the `_id` is not saved, since it can be derived from the parent:
+    _state = ('_parent', '_index',
+              'metadata', 'returnvalue', 'errorvalue', 'runtime')
+    __slots__ = _state + ('_id', '_children')
+
     def __init__(self, parent, index):
         self._parent = parent
         self._index = index
-        self._id = parent._id + str(index)
+        self.metadata = self.returnvalue = self.errorvalue = self.runtime = None
+        self._children = None
+
+    def __getstate__(self):
+        return _compact_state(self, PartOfTask._state)
+
+    def __setstate__(self, state):
+        _restore_state(self, PartOfTask._state, state)
 
     def __eq__(self, other):
-        return self._id == other._id and self._parent == other._parent
+        return type(other) is type(self) and self._id == other._id
+
+    def __hash__(self):
+        return hash(self._id)
 
     def __getattr__(self, name):
-        if name in ['__getstate__', '_id']:
-            raise AttributeError()
-        return TaskAttribute(self, name)
+        if name == '_id':
+            self._id = self._id_format.format(self._parent._id, self._index)
+            return self._id
+        return _child_task(self, TaskAttribute, name)
 
     def __getitem__(self, key):
-        return TaskItem(self, key)
+        return _child_task(self, TaskItem, key)
+
+
+# increment this whenever `Task._state` or `PartOfTask._state` change:
+_state_version = 1
+
+
+def _compact_state(task, names):
+    """Return the attributes `names` of `task`, without trailing `None`s.
+
+    Most tasks are part of other tasks, and have no metadata or
+    results, so this saves quite a few bytes. The state starts with
+    `_state_version`.
+
+    """
+    state = [_state_version]
+    for name in names:
+        try: # without calculating an `_id` that is not known yet
+            state.append(object.__getattribute__(task, name))
+        except AttributeError:
+            state.append(None)
+    while state[-1] is None:
+        state.pop()
+    return tuple(state)
+
+
+def _restore_state(task, names, state):
+    """Set the attributes `names` of `task` from `_compact_state`.
+
+    Tasks saved by older versions of RunForrest were pickled with
+    their `__dict__` instead. These are restored as well, and `True`
+    is returned, so derived attributes can be recalculated.
+
+    """
+    task._children = None
+    if type(state) is dict:
+        for name in names:
+            setattr(task, name, state.get(name))
+        return True
+    if (type(state) is not tuple or not state or type(state[0]) is not int or
+        state[0] != _state_version or len(state) > len(names) + 1):
+        version = state[0] if type(state) is tuple and state and type(state[0]) is int else None
+        raise pickle.UnpicklingError(
+            f'{type(task).__name__} was saved by an incompatible version '
+            f'of RunForrest (state version {version!r}, expected {_state_version})')
+    for name, value in itertools.zip_longest(names, state[1:]):
+        setattr(task, name, value)
+    return False
+
+
+def _child_task(parent, cls, index):
+    """Return a `cls(parent, index)`, but create each one only once."""
+    key = (cls, type(index), index)
+    if parent._children is None:
+        parent._children = {}
+    try:
+        return parent._children[key]
+    except KeyError:
+        child = parent._children[key] = _fold_child_task(parent, cls, index)
+        return child
+    except TypeError: # unhashable index
+        return _fold_child_task(parent, cls, index)
+
+
+def _fold_child_task(parent, cls, index):
+    """Return a `cls(parent, index)`, or its value if it is known already.
+
+    Indexes and attributes of immutable builtin data from
+    `defer(data)` do not depend on other tasks, and are accessed right
+    away. This keeps call graphs small, but does not run user code
+    early. Mutable data such as dicts and lists might still change
+    before the task is evaluated, and are therefore never folded.
+
+    """
+    if (type(parent) is Task and parent._fun is _identity and
+        not parent._deferred_args and _is_immutable(parent._args[0])):
+        data = parent._args[0]
+        try:
+            if cls is TaskItem and type(data) in (tuple, str, bytes):
+                value = data[index]
+            elif cls is TaskAttribute:
+                value = getattr(data, index)
+            else:
+                return cls(parent, index)
+        except Exception:
+            return cls(parent, index) # fail during evaluation instead
+        if _is_immutable(value):
+            return Task(_identity, [value], {})
+    return cls(parent, index)
+
+
+def _is_immutable(value):
+    """Whether `value` is builtin data that can never change."""
+    if type(value) in _immutable_types:
+        return True
+    if type(value) in (tuple, frozenset):
+        return all(_is_immutable(item) for item in value)
+    return False
 
 
 class TaskAttribute(PartOfTask):
-    pass
+    __slots__ = ()
+    _id_format = '{}.{}'
 
 
 class TaskItem(PartOfTask):
-    pass
+    __slots__ = ()
+    _id_format = '{}[{!r}]'
 
 
 class TaskList:
@@ -116,6 +774,13 @@ class TaskList:
 
     """
 
+    # maximum bytes of scheduled tasks that are kept in memory:
+    _pending_limit = 64 * 1024 * 1024
+    # maximum bytes of task files that are cached by the task iterators:
+    _read_cache_limit = 16 * 1024 * 1024
+    # scheduled tasks smaller than this are passed on the command line:
+    _inline_limit = 4096
+
     def __init__(self, directory, exist_ok=False, pre_clean=True,
                  post_clean=False, logfile=None, noschedule_if_exist=False):
         self._directory = Path(directory)
@@ -136,14 +801,52 @@ class TaskList:
                     self._directory / 'done', self._directory / 'fail']:
             if not dir.exists():
                 dir.mkdir()
+        # as `str`, so finishing a task does not need `Path` operations:
+        self._todo = str(self._directory / 'todo')
+        self._done = str(self._directory / 'done')
+        self._fail = str(self._directory / 'fail')
+
+        # task files that are not named by their content are named
+        # by a random session prefix and a counter:
+        self._session = os.urandom(6).hex()
+        self._counter = itertools.count()
 
         self._processes = {}
+        self._selector = selectors.DefaultSelector()
+        self._use_pidfd = hasattr(os, 'pidfd_open') # Linux only
+        self._backoff = 0.001
+        # finished tasks are loaded in the background:
+        from concurrent.futures import ThreadPoolExecutor
+        self._loader = ThreadPoolExecutor(max_workers=2)
+        # worker processes for `run(reuse_processes=True)`:
+        self._pool = None
+        self._pool_size = None
+        # digests of the last saved session, and the one loaded by the pool:
+        self._session_digest = None
+        self._pool_session = None
+        self._loading = {}
+        self._pending = {}
+        self._pending_size = 0
+        # `_id`s of all sub-tasks scheduled so far:
+        self._shared_tasks = set()
+        # contents of task files, while they are unchanged:
+        self._read_cache = _FileCache(self._read_cache_limit)
+        # keep the logfile open, instead of opening it for every line:
+        self._logstream = self._logfile.open('a', buffering=1) if self._logfile else None
 
     def __del__(self):
-        if self._post_clean:
-            self.clean()
+        try:
+            # at interpreter shutdown, this might fail, but the
+            # directory should be cleaned nevertheless:
+            if getattr(self, '_pool', None) is not None:
+                self._pool.shutdown(wait=False)
+            if getattr(self, '_logstream', None) is not None:
+                self._logstream.close()
+        finally:
+            if self._post_clean:
+                self.clean()
 
-    def schedule(self, task, metadata=None):
+    def schedule(self, task, metadata=None, skip_done=False):
         """Schedule a task for later execution.
 
         The task is saved to the `{directory}/todo` directory. Use
@@ -153,26 +856,116 @@ class TaskList:
         If you want, you can attach metadata to the task, which you
         can retrieve as `task.metadata` after the task has been run.
 
+        If `skip_done=True`, the task file is named by the task's
+        function call and metadata. Scheduling an equal task with equal
+        metadata again then does not run it twice, and tasks that are
+        already done are not scheduled at all.
+
+        """
+
+        if self._noschedule:
+            return
+
+        scheduled = self._prepare_task(task, metadata, skip_done)
+        if scheduled is not None:
+            _write_file(*scheduled)
+
+    def schedule_many(self, tasks, metadata=None, skip_done=False):
+        """Schedule many tasks for later execution.
+
+        This is equivalent to calling `schedule` for every task in
+        `tasks`. If `metadata` is a list or tuple, it contains the
+        metadata of every task. Otherwise, all tasks get the same
+        `metadata`. However, task files are written by several threads
+        in parallel, which is faster for many tasks.
+
         """
 
         if self._noschedule:
             return
 
+        from concurrent.futures import ThreadPoolExecutor
+        if isinstance(metadata, (list, tuple)):
+            tasks = list(tasks)
+            if len(metadata) != len(tasks):
+                raise ValueError(f'got {len(metadata)} metadata for {len(tasks)} tasks')
+        else:
+            metadata = itertools.repeat(metadata)
+        with ThreadPoolExecutor(max_workers=4) as writers:
+            futures = []
+            for task, taskmetadata in zip(tasks, metadata):
+                scheduled = self._prepare_task(task, taskmetadata, skip_done)
+                if scheduled is not None:
+                    futures.append(writers.submit(_write_file, *scheduled))
+            for future in futures:
+                future.result() # raise any errors
+
+    def _prepare_task(self, task, metadata, skip_done):
+        """Serialize `task` for scheduling.
+
+        Returns the todo file and its contents, or `None` if the task
+        is already done and `skip_done`.
+
+        """
         task.errorvalue = None
         task.returnvalue = None
         task.metadata = metadata
 
-        taskfilename = (str(uuid()) + '.pkl')
-        with (self._directory / 'todo' / taskfilename).open('wb') as f:
-            dill.dump(task, f)
+        if skip_done:
+            taskfilename = self._task_filename(task)
+            if os.path.exists(os.path.join(self._done, taskfilename)):
+                self._log('already done', taskfilename)
+                return None
+        else:
+            taskfilename = self._unique_filename()
+        data = _dumps(task, self._directory, self._shared_tasks)
+        # keep a copy in memory, so a worker pool does not need to
+        # read it back from disk:
+        self._pop_pending(taskfilename)
+        if self._pending_size + len(data) <= self._pending_limit:
+            self._pending[taskfilename] = data
+            self._pending_size += len(data)
         self._log('schedule', taskfilename)
+        return os.path.join(self._todo, taskfilename), data
+
+    def _task_filename(self, task):
+        """Name the task file of `task` by its `_id` and metadata."""
+        try:
+            return _IdPickler().hexdigest((task._id, task.metadata)) + '.pkl'
+        except Exception:
+            # metadata that can't be pickled:
+            return self._unique_filename()
 
-    def run(self, nprocesses=4, print_errors=False, save_session=False, autokill=None):
+    def _unique_filename(self):
+        """Name a task file by the session and a counter."""
+        return f'{self._session}_{next(self._counter):08d}.pkl'
+
+    def run(self, nprocesses=4, print_errors=False, save_session=False, autokill=None,
+            reuse_processes=False, batch_size=1, pin_processes=False):
         """Execute all tasks in the `{directory}/todo}` directory.
 
         All tasks are executed in their own processes, and `run` makes
         sure that no more than `nprocesses` are active at any time.
 
+        If `reuse_processes=True`, tasks are instead executed by a
+        pool of `nprocesses` long-lived worker processes. This saves
+        the interpreter startup for every task, which can dominate
+        the run time of many short tasks. The pool is kept alive for
+        later `run`s with the same `nprocesses`. However, a crashing task
+        might take down the whole pool, and the `logfile` capture of
+        task output is not available in this mode. `autokill`,
+        `batch_size`, and `pin_processes` raise a `ValueError` in this
+        mode.
+
+        Alternatively, set `batch_size` to execute that many tasks one
+        after another in each process. A crashing task then only takes
+        down its own batch, and `autokill` kills whole batches.
+
+        If `pin_processes=True`, each process is pinned to the least busy
+        CPU, and scheduled as a batch process. This avoids migrating
+        short tasks between CPUs, but confines multi-threaded tasks to
+        a single CPU. It has no effect on platforms other than Linux.
+
         If `print_errors=True`, processes will print full stack traces
         of failing tasks. Since these errors happen on another
         process, this will not be caught by the debugger, and will not
@@ -183,8 +976,13 @@ class TaskList:
 
         """
 
+        if reuse_processes and (autokill is not None or batch_size != 1 or pin_processes):
+            raise ValueError('autokill, batch_size, and pin_processes are not '
+                             'supported with reuse_processes=True')
+
         if save_session:
-            dill.dump_session(self._directory / 'session.pkl')
+            self._session_digest = _save_session(self._directory / 'session.pkl',
+                                                 self._session_digest)
 
         class TaskIterator:
             def __init__(self, parent, todos, save_session):
@@ -193,132 +991,380 @@ class TaskList:
                 self.save_session = save_session
 
             def __iter__(self):
-                for todo in self.todos:
+                if reuse_processes:
+                    yield from self.parent._pool_tasks(iter(self.todos), nprocesses,
+                                                       print_errors, save_session)
+                    return
+                todos = iter(self.todos)
+                while True:
+                    batch = list(itertools.islice(todos, batch_size))
+                    if not batch:
+                        break
                     yield from self.parent._finish_tasks(nprocesses, autokill=autokill)
-                    self.parent._start_task(todo.name, print_errors, save_session)
+                    self.parent._start_task(batch, print_errors, save_session,
+                                            pin_processes)
                 # wait for running jobs to finish:
                 yield from self.parent._finish_tasks(1, autokill=autokill)
+                yield from self.parent._loaded_tasks(wait=True)
 
             def __len__(self):
                 return len(self.todos)
 
-        return TaskIterator(self, list((self._directory / 'todo').iterdir()), save_session)
+        # finished tasks are removed from `{directory}/todo`, and
+        # directory streams might skip entries if files are removed
+        # while they are open. So list all todos first:
+        return TaskIterator(self, os.listdir(self._todo), save_session)
+
+    def _pop_pending(self, taskfilename):
+        """Return and forget the in-memory copy of a task, if any."""
+        data = self._pending.pop(taskfilename, None)
+        if data is not None:
+            self._pending_size -= len(data)
+        return data
+
+    def _start_task(self, taskfilenames, print_errors, save_session, pin_processes=False):
+        """Start a new process for `taskfilenames`, and append to self._processes.
+
+        The process is known by the first of `taskfilenames`.
 
-    def _start_task(self, taskfilename, print_errors, save_session):
-        """Start a new process, and append to self._processes."""
-        args = ['python', '-m', 'runforrest',
-                self._directory / 'todo' / taskfilename,
-                self._directory / 'done' / taskfilename]
+        """
+        from subprocess import Popen, PIPE, STDOUT
+        taskfilename, *batch = taskfilenames
+        data = self._pop_pending(taskfilename)
+        args = [sys.executable, '-m', 'runforrest',
+                os.path.join(self._todo, taskfilename),
+                os.path.join(self._done, taskfilename)]
+        if data is not None and len(data) < self._inline_limit:
+            # the todo file is still needed if something goes wrong,
+            # but the process does not have to read it:
+            args += ['-i', base64.b64encode(data)]
+        for file in batch:
+            self._pop_pending(file)
+            args += ['-b', os.path.join(self._todo, file), os.path.join(self._done, file)]
         if print_errors:
             args += ['-p']
         if save_session:
             args += ['-s', self._directory / 'session.pkl']
-        kwargs = dict(start_new_session=True, cwd=os.getcwd())
+        # Popen uses vfork where possible, so launching does not copy the
+        # page tables of a large parent process:
+        kwargs = dict(start_new_session=True)
         if self._logfile:
             kwargs['stdout'] = PIPE
             kwargs['stderr'] = STDOUT
-        self._processes[taskfilename] = Popen(args, **kwargs)
-        self._processes[taskfilename].start_time = time.perf_counter()
-        self._log('start', taskfilename)
+        waitfd = sentinel = None
+        if not self._use_pidfd and os.name == 'posix':
+            # the process inherits the write end of a pipe, and the
+            # read end becomes readable once the process exits. Other
+            # platforms can't pass or select pipes, and poll instead:
+            waitfd, sentinel = os.pipe()
+            kwargs['pass_fds'] = (sentinel,)
+        proc = Popen(args, **kwargs)
+        proc.start_time = time.perf_counter()
+        proc.cpu = None
+        if pin_processes:
+            # pin from here instead of with `preexec_fn`, which would
+            # prevent Popen from using vfork:
+            self._pin_process(proc)
+        if self._use_pidfd:
+            try:
+                waitfd = os.pidfd_open(proc.pid)
+            except OSError: # not supported by the kernel
+                self._use_pidfd = False
+        elif sentinel is not None:
+            os.close(sentinel)
+        proc.waitfd = waitfd
+        proc.taskfilenames = taskfilenames
+        if waitfd is not None:
+            self._selector.register(waitfd, selectors.EVENT_READ, taskfilename)
+        self._processes[taskfilename] = proc
+        for file in taskfilenames:
+            self._log('start', file)
+
+    def _pin_process(self, proc):
+        """Pin `proc` to the least busy CPU, and schedule it as a batch process."""
+        try:
+            busy = [other.cpu for other in self._processes.values()]
+            proc.cpu = min(sorted(os.sched_getaffinity(0)), key=busy.count)
+            os.sched_setaffinity(proc.pid, {proc.cpu})
+            os.sched_setscheduler(proc.pid, os.SCHED_BATCH, os.sched_param(0))
+        except (AttributeError, OSError):
+            pass # not supported on this platform
+
+    def _remove_process(self, taskfilename):
+        """Remove a process from self._processes."""
+        proc = self._processes.pop(taskfilename)
+        self._close_waitfd(proc)
+
+    def _close_waitfd(self, proc):
+        """Stop waiting on the pidfd or pipe of `proc`."""
+        if proc.waitfd is not None:
+            self._selector.unregister(proc.waitfd)
+            os.close(proc.waitfd)
+            proc.waitfd = None
+
+    def _ready_processes(self, timeout):
+        """Wait up to `timeout` seconds and return processes that might have exited.
+
+        Returns the task file names of these processes, and whether
+        their pidfd or pipe signaled that they exited.
+
+        """
+        if len(self._selector.get_map()) == len(self._processes):
+            # every process has a pidfd or pipe, which becomes readable on
+            # exit, so only the ready ones need to be polled:
+            return [key.data for key, _ in self._selector.select(timeout)], True
+        if timeout is None or timeout > 0:
+            # poll with exponential backoff, so short tasks are noticed
+            # quickly, but long tasks are not polled needlessly often:
+            time.sleep(self._backoff if timeout is None else min(self._backoff, timeout))
+            self._backoff = min(self._backoff * 2, 0.1)
+        return list(self._processes), False
+
+    def _pool_tasks(self, todos, nprocesses, print_errors, save_session):
+        """Execute `todos` on a pool of worker processes and return finished tasks."""
+        from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+        from concurrent.futures.process import BrokenProcessPool
+        # a changed session must be loaded by new workers:
+        if self._pool is not None and (self._pool_size != nprocesses or save_session and
+                                       self._pool_session != self._session_digest):
+            self._shutdown_pool()
+        if self._pool is None:
+            import multiprocessing
+            # forking this process is unsafe, since it runs threads:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context('spawn')
+            kwargs = dict(max_workers=nprocesses, mp_context=context)
+            if save_session:
+                kwargs['initializer'] = _load_session
+                kwargs['initargs'] = (str(self._directory / 'session.pkl'),)
+            self._pool = ProcessPoolExecutor(**kwargs)
+            self._pool_session = self._session_digest if save_session else None
+            self._pool_size = nprocesses
+
+        futures = {}
+        try:
+            for todo in todos:
+                future = self._pool.submit(run_task_inproc,
+                                           self._directory / 'todo' / todo,
+                                           self._directory / 'done' / todo,
+                                           print_errors, self._pop_pending(todo))
+                futures[future] = todo
+                self._log('start', todo)
+            for future in as_completed(futures):
+                file = futures[future]
+                task = self._retrieve_task(file, future)
+                self._log('done' if task.errorvalue is None else 'fail', file)
+                yield task
+        finally:
+            # like leaving a `with ProcessPoolExecutor()`, do not leave
+            # tasks running in the background:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            if any(isinstance(future.exception(), BrokenProcessPool)
+                   for future in futures if not future.cancelled()):
+                self._shutdown_pool()
+
+    def _shutdown_pool(self):
+        """Stop the worker processes of `run(reuse_processes=True)`."""
+        self._pool.shutdown()
+        self._pool = None
 
     def _finish_tasks(self, nprocesses, autokill):
         """Wait while `nprocesses` are running and return finished tasks."""
+        from subprocess import TimeoutExpired
+        ready, signaled = self._ready_processes(0)
         while len(self._processes) >= nprocesses:
-            for file, proc in list(self._processes.items()):
+            # reap all finished processes before yielding any of them, so
+            # that one wake-up collects every task that finished meanwhile:
+            batch = []
+            killed = False
+            for file in ready:
+                proc = self._processes.get(file)
+                if proc is None:
+                    continue
                 if proc.poll() is not None:
-                    task = self._retrieve_task(file)
-                    try:
-                        stdout, _ = proc.communicate(timeout=10)
-                        self._log('done' if task.errorvalue is None else 'fail', file)
-                        if stdout:
-                            self._log(stdout, file)
-                        yield task
-                    except subprocess.TimeoutExpired as err:
-                        # something is wrong. Kill the process and move on.
-                        process_group = os.getpgid(proc.pid)
-                        os.killpg(process_group, signal.SIGKILL)
-                        self._log('lost contact', file)
-                    finally:
-                        del self._processes[file]
-                elif autokill and time.perf_counter() - proc.start_time > autokill:
-                    try:
-                        # kill the whole process group.
-                        # This is a mean thing to do, and might leave dangling
-                        # intermedite files. But at this point, the program was
-                        # provably not able to terminate on its own, and drastic
-                        # measures are our last resort.
-                        process_group = os.getpgid(proc.pid)
-                        os.killpg(process_group, signal.SIGKILL)
-                        self._log('autokilled', file)
-                        # sometimes, even the above does not work. In this case,
-                        # we will leak the process, but continue anyway:
-                        del self._processes[file]
-                    except Exception as err:
-                        self._log(err.message, file)
+                    batch.append((file, proc))
+                elif signaled:
+                    # the process closed its sentinel pipe without exiting,
+                    # so fall back to polling it:
+                    self._close_waitfd(proc)
+            if autokill:
+                for file, proc in list(self._processes.items()):
+                    if proc.returncode is None and time.perf_counter() - proc.start_time > autokill:
+                        try:
+                            # kill the whole process group.
+                            # This is a mean thing to do, and might leave dangling
+                            # intermedite files. But at this point, the program was
+                            # provably not able to terminate on its own, and drastic
+                            # measures are our last resort.
+                            process_group = os.getpgid(proc.pid)
+                            os.killpg(process_group, signal.SIGKILL)
+                            for taskfile in proc.taskfilenames:
+                                if os.path.exists(os.path.join(self._done, taskfile)):
+                                    # finished before its batch was killed:
+                                    future = self._loader.submit(self._retrieve_task, taskfile)
+                                    self._loading[future] = (taskfile, None)
+                                else:
+                                    self._log('autokilled', taskfile)
+                            # sometimes, even the above does not work. In this case,
+                            # we will leak the process, but continue anyway:
+                            self._remove_process(file)
+                            killed = True
+                        except Exception as err:
+                            self._log(err.message, file)
+            for file, proc in batch:
+                # load the tasks in the background, so that the next
+                # process can start right away:
+                futures = [self._loader.submit(self._retrieve_task, taskfile)
+                           for taskfile in proc.taskfilenames]
+                try:
+                    stdout, _ = proc.communicate(timeout=10)
+                    for taskfile, future in zip(proc.taskfilenames, futures):
+                        self._loading[future] = (taskfile, stdout if taskfile == file else None)
+                except TimeoutExpired as err:
+                    # something is wrong. Kill the process and move on.
+                    process_group = os.getpgid(proc.pid)
+                    os.killpg(process_group, signal.SIGKILL)
+                    self._log('lost contact', file)
+                finally:
+                    self._remove_process(file)
+            yield from self._loaded_tasks(wait=False)
+            if batch or killed:
+                self._backoff = 0.001
+                ready, signaled = self._ready_processes(0)
             else:
-                time.sleep(0.1)
+                ready, signaled = self._ready_processes(self._wait_timeout(autokill))
+
+    def _wait_timeout(self, autokill):
+        """How long to wait for processes before checking back."""
+        timeout = None
+        if autokill:
+            # wake up when the next process is due to be killed:
+            deadline = min(proc.start_time for proc in self._processes.values()) + autokill
+            timeout = max(deadline - time.perf_counter(), 0)
+        if self._loading:
+            # check back on loading tasks every now and then:
+            timeout = 0.1 if timeout is None else min(timeout, 0.1)
+        return timeout
+
+    def _loaded_tasks(self, wait):
+        """Return tasks that finished loading, or wait for all if `wait`."""
+        from concurrent.futures import as_completed
+        if wait:
+            futures = as_completed(list(self._loading))
+        else:
+            futures = [future for future in self._loading if future.done()]
+        for future in futures:
+            file, stdout = self._loading.pop(future)
+            task = future.result()
+            self._log('done' if task.errorvalue is None else 'fail', file)
+            if stdout:
+                self._log(stdout, file)
+            yield task
+
+    def _retrieve_task(self, taskfilename, future=None):
+        """Load task, and sort into `{directory}/done` or `{directory}/fail`.
+
+        If the task was executed by a worker pool, its result is taken
+        from `future` instead of `{directory}/done`.
 
-    def _retrieve_task(self, taskfilename):
-        """Load task, and sort into `{directory}/done` or `{directory}/fail`."""
+        """
         try:
-            with (self._directory / 'done' / taskfilename).open('rb') as f:
-                task = dill.load(f)
+            if future is not None:
+                task = _loads(future.result(), self._directory)
+            else:
+                task = _loads(_read_file(os.path.join(self._done, taskfilename)),
+                              self._directory)
         except Exception as error:
-            with (self._directory / 'todo' / taskfilename).open('rb') as f:
-                task = dill.load(f)
-                task.returnvalue = None
-                task.errorvalue = error
-            with (self._directory / 'done' / taskfilename).open('wb') as f:
-                dill.dump(task, f)
+            task = _loads(_read_file(os.path.join(self._todo, taskfilename)),
+                          self._directory)
+            task.returnvalue = None
+            task.errorvalue = error
+            _write_file(os.path.join(self._done, taskfilename),
+                        _dumps(task, self._directory, self._shared_tasks))
 
-        (self._directory / 'todo' / taskfilename).unlink()
+        os.unlink(os.path.join(self._todo, taskfilename))
 
         if task.errorvalue is not None:
-            (self._directory / 'done' / taskfilename).rename(self._directory / 'fail' / taskfilename)
+            os.rename(os.path.join(self._done, taskfilename),
+                      os.path.join(self._fail, taskfilename))
 
         return task
 
     def _log(self, message, taskfilename):
-        if not self._logfile:
+        if not self._logstream:
             return
-        with self._logfile.open('a') as f:
-            f.write(f"{time.strftime('%Y-%m-%dT%H:%M:%S')} {taskfilename} {message}\n")
+        self._logstream.write(f"{time.strftime('%Y-%m-%dT%H:%M:%S')} {taskfilename} {message}\n")
 
     def todo_tasks(self):
         """Yield all tasks in `{directory}/todo`."""
-        for todo in (self._directory / 'todo').iterdir():
-            with todo.open('rb') as f:
-                yield dill.load(f)
+        with os.scandir(self._todo) as entries:
+            for todo in entries:
+                yield self._load_entry(todo)
 
     def done_tasks(self):
         """Yield all tasks in `{directory}/done`."""
-        for done in (self._directory / 'done').iterdir():
-            with done.open('rb') as f:
+        with os.scandir(self._done) as entries:
+            for done in entries:
                 try: # safeguard against broken tasks:
-                    yield dill.load(f)
+                    task = self._load_entry(done)
                 except EOFError as err:
                     print(f'skipping {done.name} ({err})')
+                    continue
+                yield task
 
     def fail_tasks(self):
         """Yield all tasks in `{directory}/fail`."""
-        for fail in (self._directory / 'fail').iterdir():
-            with fail.open('rb') as f:
-                yield dill.load(f)
+        with os.scandir(self._fail) as entries:
+            for fail in entries:
+                yield self._load_entry(fail)
+
+    def _load_entry(self, entry):
+        """Load the task file at `os.DirEntry` `entry`.
+
+        File contents are cached while the file is unchanged, so
+        iterating over the same tasks again does not need to read them
+        again. Every call returns new tasks, though.
+
+        """
+        data = self._read_cache.read(entry.path, entry.stat())
+        return _loads(data, self._directory)
 
     def clean(self, clean_todo=True, clean_done=True, clean_fail=True):
         """Remove `{directory}` and all todo/done/fail tasks."""
         def remove(dir):
-            if dir.exists():
+            # `clean` might run from `__del__` during interpreter
+            # shutdown, when `os` is no longer available. `Path` still is.
+            if not dir.exists():
+                return
+            if os is not None:
+                # without a `Path` for every file. Like `shutil.rmtree`,
+                # list all files before removing any, since directory
+                # streams might skip entries if files are removed:
+                with os.scandir(dir) as entries:
+                    paths = [entry.path for entry in entries]
+                for path in paths:
+                    os.unlink(path)
+            else:
                 for f in dir.iterdir():
                     f.unlink()
-                dir.rmdir()
+            dir.rmdir()
         if clean_todo:
             remove(self._directory / 'todo')
         if clean_fail:
             remove(self._directory / 'fail')
         if clean_done:
             remove(self._directory / 'done')
+        # forget the contents of removed files:
+        if getattr(self, '_read_cache', None) is not None:
+            self._read_cache.clear()
         if clean_todo and clean_fail and clean_done:
+            if _shared_files is not None:
+                _shared_files.clear()
+            remove(self._directory / 'shared')
             if (self._directory / 'session.pkl').exists():
                 (self._directory / 'session.pkl').unlink()
             remove(self._directory)
@@ -331,12 +1377,18 @@ def main():
     parser.add_argument('-s', '--sessionfile', type=Path, action='store', default=None)
     parser.add_argument('-p', '--do_print', action='store_true', default=False)
     parser.add_argument('-r', '--do_raise', action='store_true', default=False)
+    parser.add_argument('-i', '--inline', action='store', default=None,
+                        help='the contents of infile, base64-encoded')
+    parser.add_argument('-b', '--batch', type=Path, nargs=2, action='append', default=[],
+                        metavar=('INFILE', 'OUTFILE'), help='execute another task afterwards')
 
     args = parser.parse_args()
-    run_task(args.infile, args.outfile, args.sessionfile, args.do_print, args.do_raise)
+    taskdata = base64.b64decode(args.inline) if args.inline else None
+    run_task(args.infile, args.outfile, args.sessionfile, args.do_print, args.do_raise,
+             taskdata, args.batch)
 
 
-def run_task(infile, outfile, sessionfile, do_print, do_raise):
+def run_task(infile, outfile, sessionfile, do_print, do_raise, taskdata=None, batch=()):
     """Execute `infile` and produce `outfile`.
 
     If `sessionfile` is given, load session from that file.
@@ -344,13 +1396,60 @@ def run_task(infile, outfile, sessionfile, do_print, do_raise):
     Set `do_print` or `do_raise` to `True` if errors should be printed or
     raised.
 
+    If `taskdata` is given, it is used instead of reading `infile`.
+
+    Afterwards, execute every `(infile, outfile)` in `batch` as well.
+
     """
 
     if sessionfile:
-        dill.load_session(Path(sessionfile))
+        _load_session(Path(sessionfile))
+
+    failed = False
+    for infile, outfile, taskdata in [(infile, outfile, taskdata),
+                                      *((i, o, None) for i, o in batch)]:
+        task, _ = _execute_task(infile, outfile, taskdata)
+
+        if task.errorvalue is not None and do_raise:
+            raise task.errorvalue
+
+        if task.errorvalue is not None and do_print:
+            print(f'Error in {infile.name}: {task.errorvalue.__repr__()}')
+
+        failed = failed or task.errorvalue is not None
+
+    sys.exit(-1 if failed else 0)
+
+
+def run_task_inproc(infile, outfile, do_print, taskdata=None):
+    """Execute `infile`, produce `outfile`, and return its contents.
+
+    This is the worker function of `TaskList.run(reuse_processes=True)`.
+    It does the same as `run_task`, but keeps the process alive.
 
-    with infile.open('rb') as f:
-        task = dill.load(f)
+    If `taskdata` is given, it is used instead of reading `infile`.
+
+    """
+
+    task, data = _execute_task(infile, outfile, taskdata)
+
+    if task.errorvalue is not None and do_print:
+        print(f'Error in {infile.name}: {task.errorvalue.__repr__()}')
+
+    return data
+
+
+def _execute_task(infile, outfile, taskdata=None):
+    """Evaluate the task in `infile` and save it to `outfile`."""
+
+    directory = infile.parent.parent
+    # sub-tasks that are loaded from `{directory}/shared` are saved
+    # there as well:
+    shared_names = set()
+    if taskdata is not None:
+        task = _loads(taskdata, directory, shared_names)
+    else:
+        task = _loads(_read_file(infile), directory, shared_names)
 
     try:
         start_time = time.perf_counter()
@@ -361,16 +1460,10 @@ def run_task(infile, outfile, sessionfile, do_print, do_raise):
         task.returnvalue = None
     finally:
         task.runtime = time.perf_counter() - start_time
-        with outfile.open('wb') as f:
-            dill.dump(task, f)
-
-    if task.errorvalue is not None and do_raise:
-        raise task.errorvalue
+        data = _dumps(task, directory, shared_names)
+        _write_file(outfile, data)
 
-    if task.errorvalue is not None and do_print:
-        print(f'Error in {infile.name}: {task.errorvalue.__repr__()}')
-
-    sys.exit(0 if task.errorvalue is None else -1)
+    return task, data
 
 
 def evaluate(task, known_results=None):
@@ -381,36 +1474,78 @@ def evaluate(task, known_results=None):
     executed more than once, even if several `PartOfTasks` lead to
     the same original `Task`.
 
-    This is a recursive function that passes its state in
-    `known_results`, where return values of all executed `Tasks` are
-    stored.
+    The call chain is walked with an explicit stack instead of
+    recursion, so arbitrarily deep call chains can be evaluated.
+    Return values of all executed `Tasks` are stored in
+    `known_results`.
 
     """
 
-    # because pickling breaks isinstance(task, Task)
-    if not 'Task' in task.__class__.__name__:
+    if type(task) not in _evaluators:
         return task
 
     if known_results is None:
         known_results = {}
 
-    if task._id not in known_results:
-        if task.__class__.__name__ in ['TaskItem', 'TaskAttribute']:
-            returnvalue = evaluate(task._parent, known_results)
-            if task.__class__.__name__ == 'TaskItem':
-                known_results[task._id] = returnvalue[task._index]
-            elif task.__class__.__name__ == 'TaskAttribute':
-                known_results[task._id] = getattr(returnvalue, task._index)
-            else:
-                raise TypeError(f'unknown Task {type(task)}')
-        else: # is Task
-            args = [evaluate(arg, known_results) for arg in task._args]
-            kwargs = {k: evaluate(v, known_results) for k, v in task._kwargs.items()}
-            returnvalue = task._fun(*args, **kwargs)
-            known_results[task._id] = returnvalue
+    evaluators = _evaluators
+    # each node is visited twice: once to push its dependencies, and
+    # once more to evaluate it, after all dependencies are evaluated:
+    stack = [(task, False)]
+    while stack:
+        node, dependencies_known = stack.pop()
+        if node._id in known_results:
+            continue
+        evaluator = evaluators[type(node)]
+        if dependencies_known:
+            known_results[node._id] = evaluator(node, known_results)
+            continue
+
+        stack.append((node, True))
+        if evaluator is _call_task:
+            for idx in node._deferred_args:
+                if node._args[idx]._id not in known_results:
+                    stack.append((node._args[idx], False))
+            for key in node._deferred_kwargs:
+                if node._kwargs[key]._id not in known_results:
+                    stack.append((node._kwargs[key], False))
+        elif node._parent._id not in known_results:
+            stack.append((node._parent, False))
 
     return known_results[task._id]
 
 
+def _call_task(task, known_results):
+    """Call the function of a `Task` with evaluated arguments."""
+    args = task._args
+    if task._deferred_args:
+        args = list(args)
+        for idx in task._deferred_args:
+            args[idx] = known_results[args[idx]._id]
+    kwargs = task._kwargs
+    if task._deferred_kwargs:
+        kwargs = dict(kwargs)
+        for key in task._deferred_kwargs:
+            kwargs[key] = known_results[kwargs[key]._id]
+    return task._fun(*args, **kwargs)
+
+
+def _index_task(task, known_results):
+    """Index the evaluated parent of a `TaskItem`."""
+    return known_results[task._parent._id][task._index]
+
+
+def _getattr_task(task, known_results):
+    """Get an attribute of the evaluated parent of a `TaskAttribute`."""
+    return getattr(known_results[task._parent._id], task._index)
+
+
+# how to evaluate each type of task:
+_evaluators = {Task: _call_task, TaskItem: _index_task, TaskAttribute: _getattr_task}
+
+
 if __name__ == '__main__':
-    main()
+    # Tasks are unpickled as instances of the classes in the
+    # `runforrest` module, not of the ones in `__main__`, so run
+    # from the `runforrest` module:
+    import runforrest
+    runforrest.main()
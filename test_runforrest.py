@@ -1,5 +1,8 @@
 import runforrest
 import pathlib
+import pickle
+import time
+import threading
 
 def identity(n):
     return n
@@ -13,6 +16,16 @@ def test_run():
     assert tasks[0].returnvalue == 42
 
 
+def test_run_length(howmany=5):
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    for idx in range(howmany):
+        tasklist.schedule(runforrest.defer(identity, idx))
+    tasks = tasklist.run(nprocesses=2)
+    for _ in tasks:
+        # finished tasks are no longer todo, but still count:
+        assert len(tasks) == howmany
+
+
 def test_data_task():
     tasklist = runforrest.TaskList('tmp', post_clean=True)
     task = runforrest.defer(42)
@@ -21,6 +34,25 @@ def test_data_task():
     assert tasks[0].returnvalue == 42
 
 
+def test_schedule_many(howmany=20):
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasks = [runforrest.defer(identity, v) for v in range(howmany)]
+    tasklist.schedule_many(tasks, metadata=list(range(howmany)))
+    tasks = list(tasklist.run(nprocesses=4))
+    assert sorted(t.returnvalue for t in tasks) == list(range(howmany))
+    assert all(t.returnvalue == t.metadata for t in tasks)
+
+
+def test_schedule_many_metadata():
+    import pytest # task processes import this module, so do not slow them down
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasks = [runforrest.defer(identity, v) for v in range(5)]
+    with pytest.raises(ValueError):
+        tasklist.schedule_many(tasks, metadata=[1, 2])
+    tasklist.schedule_many(tasks, metadata={'same': 'metadata'})
+    assert [t.metadata for t in tasklist.todo_tasks()] == [{'same': 'metadata'}] * 5
+
+
 def test_nested_run():
     tasklist = runforrest.TaskList('tmp', post_clean=True)
     task = runforrest.defer(identity, 42)
@@ -53,6 +85,39 @@ def test_multiple_nested_runs(howmany=20):
         assert r == v
 
 
+def test_lambda_run():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    task = runforrest.defer(lambda n: n + 1, 41)
+    tasklist.schedule(task)
+    tasks = list(tasklist.run(nprocesses=1))
+    assert tasks[0].returnvalue == 42
+
+
+def test_lambda_stored_once():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    increment = lambda n: n + 1
+    for v in range(3):
+        tasklist.schedule(runforrest.defer(increment, v))
+    assert len(list(pathlib.Path('tmp/shared').iterdir())) == 1
+    tasks = list(tasklist.run(nprocesses=2))
+    assert sorted(t.returnvalue for t in tasks) == [1, 2, 3]
+
+
+def test_changed_lambda_pickled_again():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    add = lambda n, step=1: n + step
+    step = [1]
+    add_step = lambda n: n + step[0]
+    tasklist.schedule(runforrest.defer(add, 1), metadata=1)
+    tasklist.schedule(runforrest.defer(add_step, 1), metadata=2)
+    add.__defaults__ = (2,)
+    step[0] = 2
+    tasklist.schedule(runforrest.defer(add, 1), metadata=3)
+    tasklist.schedule(runforrest.defer(add_step, 1), metadata=4)
+    tasks = list(tasklist.run(nprocesses=2))
+    assert sorted((t.metadata, t.returnvalue) for t in tasks) == [(1, 2), (2, 2), (3, 3), (4, 3)]
+
+
 def test_task_accessor():
     tasklist = runforrest.TaskList('tmp', post_clean=True)
     # send something that has an attribute:
@@ -75,6 +140,201 @@ def test_task_indexing():
     assert tasks[0].returnvalue == 42
 
 
+def test_task_parts_are_created_once():
+    task = runforrest.defer(identity, [42])
+    assert task[0] is task[0]
+    assert task.args is task.args
+    assert task[0] is not task[False]
+    assert task[[0]] == task[[0]] # unhashable index
+
+
+def test_literal_parts_are_folded():
+    task = runforrest.defer(('value', (23, 42)))[1][1]
+    assert type(task) is runforrest.Task
+    assert runforrest.evaluate(task) == 42
+    assert runforrest.defer(1+2j).imag == runforrest.defer(2.0)
+    # invalid accesses still fail during evaluation:
+    task = runforrest.defer((23, 42))[2]
+    assert type(task) is runforrest.TaskItem
+    # mutable data might change before evaluation:
+    config = {'value': 0.1}
+    task = runforrest.defer(config)['value']
+    config['value'] = 0.5
+    assert type(task) is runforrest.TaskItem
+    assert runforrest.evaluate(task) == 0.5
+
+
+def test_legacy_task_state():
+    # older versions pickled the `__dict__` of tasks:
+    task = runforrest.Task.__new__(runforrest.Task)
+    task.__setstate__({'_fun': identity, '_args': [[1, 2]], '_kwargs': {}, '_id': '1'})
+    item = runforrest.TaskItem.__new__(runforrest.TaskItem)
+    item.__setstate__({'_parent': task, '_index': 0, '_id': '10'})
+    assert runforrest.evaluate(item) == 1
+    assert task.returnvalue is None
+
+
+def test_incompatible_task_state():
+    import pytest
+    task = runforrest.defer(identity, 42)
+    state = task.__getstate__()
+    with pytest.raises(pickle.UnpicklingError):
+        runforrest.Task.__new__(runforrest.Task).__setstate__(state[1:])
+    with pytest.raises(pickle.UnpicklingError):
+        runforrest.Task.__new__(runforrest.Task).__setstate__((state[0] + 1,) + state[1:])
+
+
+def test_deep_evaluate():
+    task = runforrest.defer(identity, 42)
+    for _ in range(10000): # deeper than the recursion limit
+        task = runforrest.defer(identity, task)
+    assert runforrest.evaluate(task) == 42
+
+
+recorded_calls = []
+
+def record_call(n):
+    recorded_calls.append(n)
+    return n
+
+
+def test_task_id_depends_on_code_and_data():
+    def fun():
+        return 1
+    task_id = runforrest.defer(fun)._id
+    assert runforrest.defer(fun)._id == task_id
+    fun.__code__ = (lambda: 2).__code__
+    assert runforrest.defer(fun)._id != task_id
+    # out-of-band buffers are part of the `_id`, too:
+    data = bytearray(1000)
+    task_id = runforrest.defer(len, pickle.PickleBuffer(data))._id
+    data[0] = 1
+    assert runforrest.defer(len, pickle.PickleBuffer(data))._id != task_id
+
+
+def test_task_id_ignores_set_order():
+    import subprocess
+    import sys
+    import os
+    code = ('import runforrest; '
+            'print(runforrest.defer(len, {"a", "b", "c", frozenset({"d", "e"})})._id)')
+    ids = {subprocess.run([sys.executable, '-c', code], capture_output=True, check=True,
+                          env=dict(os.environ, PYTHONHASHSEED=str(seed))).stdout
+           for seed in range(5)}
+    assert len(ids) == 1
+
+
+def test_task_id_is_calculated_lazily():
+    import pytest
+    task = runforrest.defer(identity, [1.0] * 1000)[0]
+    with pytest.raises(AttributeError):
+        runforrest.Task._id.__get__(task._parent)
+    assert task._id == runforrest.defer(identity, [1.0] * 1000)[0]._id
+    assert runforrest.Task._id.__get__(task._parent) is not None
+
+
+def test_equal_calls_evaluated_once():
+    recorded_calls.clear()
+    task = runforrest.defer(max, runforrest.defer(record_call, 1),
+                            runforrest.defer(record_call, 1),
+                            runforrest.defer(record_call, 2))
+    assert runforrest.evaluate(task) == 2
+    assert sorted(recorded_calls) == [1, 2]
+
+
+def buffer_size(buffer):
+    return len(memoryview(buffer))
+
+
+def test_concurrent_shared_writes():
+    directory = pathlib.Path('tmp')
+    directory.mkdir()
+    try:
+        for round in range(20):
+            path = directory / 'shared' / str(round)
+            threads = [threading.Thread(target=runforrest._write_shared,
+                                        args=(path, b'data'))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert path.read_bytes() == b'data'
+        assert len(list((directory / 'shared').iterdir())) == 20
+    finally:
+        for path in (directory / 'shared').iterdir():
+            path.unlink()
+        (directory / 'shared').rmdir()
+        directory.rmdir()
+
+
+def test_shared_buffers():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    buffer = pickle.PickleBuffer(bytearray(2 * 1024 * 1024))
+    for n in range(3):
+        tasklist.schedule(runforrest.defer(buffer_size, buffer), metadata=n)
+    # the buffer is stored only once:
+    assert len(list(pathlib.Path('tmp/shared').iterdir())) == 1
+    tasks = list(tasklist.run(nprocesses=2))
+    assert [t.returnvalue for t in tasks] == [2 * 1024 * 1024] * 3
+
+
+def test_shared_tasks():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    shared = runforrest.defer(identity, [1, 2, 3])
+    tasklist.schedule(runforrest.defer(sum, shared))
+    tasklist.schedule(runforrest.defer(max, shared))
+    # the second task references the shared task instead of containing it:
+    assert [p.name for p in pathlib.Path('tmp/shared').iterdir()] == [shared._id]
+    tasks = list(tasklist.run(nprocesses=2))
+    assert sorted(t.returnvalue for t in tasks) == [3, 6]
+
+
+def pop_last(values):
+    return values.pop()
+
+
+def test_shared_tasks_are_not_shared_objects():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    shared = runforrest.defer(identity, [1, 2, 3])
+    for _ in range(3):
+        tasklist.schedule(runforrest.defer(pop_last, shared))
+    # all three tasks run in the same process:
+    tasks = list(tasklist.run(nprocesses=1, batch_size=3))
+    assert [t.returnvalue for t in tasks] == [3, 3, 3]
+    # and loading them again does not see earlier modifications:
+    first = [t._args[0]._args[0] for t in tasklist.done_tasks()]
+    expected = [list(values) for values in first]
+    for values in first:
+        values.pop()
+    second = [t._args[0]._args[0] for t in tasklist.done_tasks()]
+    assert second == expected
+
+
+def test_equal_tasks_scheduled_once():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasklist.schedule(runforrest.defer(identity, 42), skip_done=True)
+    tasklist.schedule(runforrest.defer(identity, 42), skip_done=True)
+    tasklist.schedule(runforrest.defer(identity, 42), metadata='other', skip_done=True)
+    assert len(list(tasklist.todo_tasks())) == 2
+    assert len(list(tasklist.run(nprocesses=2))) == 2
+    # already done, so not scheduled again:
+    tasklist.schedule(runforrest.defer(identity, 42), skip_done=True)
+    assert len(list(tasklist.todo_tasks())) == 0
+    # but without `skip_done`, it is:
+    tasklist.schedule(runforrest.defer(identity, 42))
+    tasklist.schedule(runforrest.defer(identity, 42))
+    assert len(list(tasklist.todo_tasks())) == 2
+
+
+def test_compression():
+    import pytest # task processes import this module, so do not slow them down
+    pytest.importorskip('lz4.frame')
+    data = runforrest._dumps(list(range(100000)))
+    assert data[:1] == b'L'
+    assert runforrest._loads(data) == list(range(100000))
+
+
 def test_todo_and_done_task_access():
     tasklist = runforrest.TaskList('tmp', post_clean=True)
     task = runforrest.defer(identity, 42)
@@ -85,6 +345,23 @@ def test_todo_and_done_task_access():
     assert task == done[0] == todo[0]
 
 
+def test_done_tasks_are_cached():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasklist.schedule(runforrest.defer(identity, 42))
+    list(tasklist.run(nprocesses=1))
+    first = list(tasklist.done_tasks())
+    first[0].returnvalue = 23
+    second = list(tasklist.done_tasks())
+    assert len(tasklist._read_cache._files) == 1
+    # but every caller gets their own tasks:
+    assert second[0].returnvalue == 42
+    # and the cache is bounded by the size of the cached files:
+    tasklist._read_cache.clear()
+    tasklist._read_cache.limit = 0
+    list(tasklist.done_tasks())
+    assert len(tasklist._read_cache._files) == 0
+
+
 def test_metadata():
     tasklist = runforrest.TaskList('tmp', post_clean=True)
     task = runforrest.defer(identity, 42)
@@ -113,6 +390,71 @@ def test_failing_task():
     assert len(done) == 0
 
 
+def test_autokill():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasklist.schedule(runforrest.defer(time.sleep, 10))
+    tasklist.schedule(runforrest.defer(identity, 42))
+    start_time = time.perf_counter()
+    tasks = list(tasklist.run(nprocesses=2, autokill=1))
+    assert time.perf_counter() - start_time < 5
+    assert [t.returnvalue for t in tasks] == [42]
+    assert len(list(tasklist.todo_tasks())) == 1
+
+
+def finish_once(path):
+    # the first call finishes, all later calls hang:
+    path = pathlib.Path(path)
+    if path.exists():
+        time.sleep(10)
+    path.touch()
+
+
+def test_autokill_batch():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasklist.schedule(runforrest.defer(finish_once, 'tmp/marker'))
+    tasklist.schedule(runforrest.defer(finish_once, 'tmp/marker'))
+    tasks = list(tasklist.run(nprocesses=1, autokill=1, batch_size=2))
+    assert len(tasks) == 1
+    assert len(list(tasklist.done_tasks())) == 1
+    assert len(list(tasklist.todo_tasks())) == 1
+    pathlib.Path('tmp/marker').unlink()
+
+
+def test_run_without_pidfd(howmany=5):
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasklist._use_pidfd = False # wait on pipes instead
+    for v in range(howmany):
+        tasklist.schedule(runforrest.defer(identity, v))
+    tasks = list(tasklist.run(nprocesses=2))
+    assert sorted(t.returnvalue for t in tasks) == list(range(howmany))
+
+
+def test_save_session():
+    import __main__
+    __main__.session_value = [42]
+    __main__.session_function = lambda: 42
+    __main__.session_file = open(__file__) # can't be pickled
+    try:
+        runforrest._save_session('tmp.session')
+        del __main__.session_value, __main__.session_function
+        runforrest._load_session('tmp.session')
+        assert __main__.session_value == [42]
+        assert __main__.session_function() == 42
+    finally:
+        __main__.session_file.close()
+        for name in ['session_value', 'session_function', 'session_file']:
+            if hasattr(__main__, name):
+                delattr(__main__, name)
+        pathlib.Path('tmp.session').unlink()
+
+
+def test_run_with_session():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasklist.schedule(runforrest.defer(identity, 42))
+    tasks = list(tasklist.run(nprocesses=1, save_session=True))
+    assert tasks[0].returnvalue == 42
+
+
 def test_post_clean_true():
     tasklist = runforrest.TaskList('tmp', post_clean=True)
     task = runforrest.defer(crash)
@@ -167,3 +509,83 @@ def test_logging():
         assert 'start' in lines[1]
         assert 'done' in lines[2]
     logfile.unlink()
+
+
+def test_batch_size(howmany=7):
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    for v in range(howmany):
+        tasklist.schedule(runforrest.defer(identity, v))
+    tasklist.schedule(runforrest.defer(crash))
+    tasks = list(tasklist.run(nprocesses=2, batch_size=3))
+    assert sorted(t.returnvalue for t in tasks if t.errorvalue is None) == list(range(howmany))
+    assert len(list(tasklist.done_tasks())) == howmany
+    assert len(list(tasklist.fail_tasks())) == 1
+
+
+def test_reuse_processes(howmany=20):
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    for v in range(howmany):
+        task = runforrest.defer(identity, v)
+        tasklist.schedule(task)
+    tasks = list(tasklist.run(nprocesses=4, reuse_processes=True))
+    assert len(tasks) == howmany
+    assert sorted(t.returnvalue for t in tasks) == list(range(howmany))
+    assert len(list(tasklist.done_tasks())) == howmany
+
+
+def test_pin_processes():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    for n in range(4):
+        tasklist.schedule(runforrest.defer(identity, n))
+    tasks = list(tasklist.run(nprocesses=2, pin_processes=True))
+    assert sorted(task.returnvalue for task in tasks) == [0, 1, 2, 3]
+
+
+def test_reuse_processes_keeps_pool():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasklist.schedule(runforrest.defer(identity, 1))
+    list(tasklist.run(nprocesses=2, reuse_processes=True))
+    pool = tasklist._pool
+    tasklist.schedule(runforrest.defer(identity, 2))
+    tasks = list(tasklist.run(nprocesses=2, reuse_processes=True))
+    assert tasks[0].returnvalue == 2
+    assert tasklist._pool is pool
+
+
+def test_reuse_processes_keeps_pool_with_session():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasklist.schedule(runforrest.defer(identity, 1))
+    list(tasklist.run(nprocesses=2, reuse_processes=True, save_session=True))
+    pool = tasklist._pool
+    tasklist.schedule(runforrest.defer(identity, 2))
+    tasks = list(tasklist.run(nprocesses=2, reuse_processes=True, save_session=True))
+    assert tasks[0].returnvalue == 2
+    assert tasklist._pool is pool
+
+
+def test_reuse_processes_failing_task():
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    task = runforrest.defer(crash)
+    tasklist.schedule(task)
+    tasks = list(tasklist.run(nprocesses=1, reuse_processes=True))
+    assert tasks[0].errorvalue.args == ('TESTING',)
+    assert len(list(tasklist.fail_tasks())) == 1
+
+
+def test_reuse_processes_noschedule():
+    tasklist = runforrest.TaskList('tmp')
+    task = runforrest.defer(identity, 42)
+    tasklist.schedule(task)
+    # reopen, so the task is not held in memory:
+    tasklist = runforrest.TaskList('tmp', noschedule_if_exist=True, post_clean=True)
+    tasks = list(tasklist.run(nprocesses=1, reuse_processes=True))
+    assert tasks[0].returnvalue == 42
+
+
+def test_reuse_processes_unsupported_options():
+    import pytest
+    tasklist = runforrest.TaskList('tmp', post_clean=True)
+    tasklist.schedule(runforrest.defer(identity, 42))
+    for options in [dict(autokill=10), dict(batch_size=2), dict(pin_processes=True)]:
+        with pytest.raises(ValueError):
+            tasklist.run(nprocesses=1, reuse_processes=True, **options)